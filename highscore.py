@@ -1,16 +1,28 @@
 # Description: A simple highscore API that allows you to save and retrieve highscores.
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse, Response
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, HTMLResponse, Response, ORJSONResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 import uvicorn
-from pydantic import BaseModel
-import csv
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from functools import lru_cache
 import os
+import shutil
+import csv
+import io
+import gzip
 import argparse
 import typing
 from hashlib import sha256
 import time
+import hmac
+import orjson
+import bisect
+import array
+import anyio
+import asyncio
+import collections
 
 
 def get_args():
@@ -29,48 +41,159 @@ def file_to_string_cached(path: str) -> str:
     with open(path, "r") as file:
         return file.read()
 
-@lru_cache()
-def get_highscores(name: str) -> typing.List[typing.Dict[str, int]]:
+class Table:
     """
-    Get the highscores from a file.
+    The highscores of a table as parallel arrays, sorted by score, highest first.
 
-    Format of the file should be:
-    name,score
+    Scores are stored negated so that bisect finds the position of a new score,
+    and equal scores keep the order in which they were submitted.
+    """
+    __slots__ = ("neg_scores", "times", "names")
+
+    def __init__(self):
+        self.neg_scores = array.array("q")
+        self.times = array.array("q")
+        self.names: typing.List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def accepts(self, score: int) -> bool:
+        """
+        Check if a score is high enough to make it into the table.
+        """
+        return len(self.names) < args.size or -score < self.neg_scores[-1]
+
+    def insert(self, score: int, timestamp: int, player: str) -> bool:
+        """
+        Insert a score and drop the lowest one if the table is full.
+
+        Returns False if the score is too low to make it into the table.
+        """
+        if not self.accepts(score):
+            return False
+
+        pos = bisect.bisect_right(self.neg_scores, -score)
+        self.neg_scores.insert(pos, -score)
+        self.times.insert(pos, timestamp)
+        self.names.insert(pos, player)
+        if len(self.names) > args.size:
+            self.neg_scores.pop()
+            self.times.pop()
+            self.names.pop()
+        return True
+
+    def copy(self) -> "Table":
+        table = Table()
+        table.neg_scores = array.array("q", self.neg_scores)
+        table.times = array.array("q", self.times)
+        table.names = list(self.names)
+        return table
+
+def parse_rows(data: str) -> typing.List[typing.List[str]]:
+    """
+    Split the content of a table file into rows of name, score and time.
+    """
+    # names only end up quoted in files written by the csv module of older versions,
+    # or if they contain quotes, everything else is a plain split
+    if '"' in data:
+        return [row for row in csv.reader(io.StringIO(data)) if row]
+    return [line.rsplit(",", 2) for line in data.split("\n") if line]
+
+def format_row(player: str, score: int, timestamp: int) -> str:
+    # quote names the same way the csv module does, so parse_rows can read them back
+    if '"' in player or "," in player or "\n" in player or "\r" in player:
+        player = '"' + player.replace('"', '""') + '"'
+    return f"{player},{score},{timestamp}\n"
+
+def get_highscores(name: str) -> Table:
     """
-    highscores = []
+    Load the highscores of a table from its snapshot and replay its log.
+
+    Format of the snapshot should be:
+    name,score,time
+
+    Format of the log is the same, without the header. Its first line is a
+    marker with the digest of the snapshot the log continues:
+    #digest
+    """
+    highscores = Table()
 
     path = f"tables/{name}.csv"
 
-    if not os.path.exists(path):
-        update_highscores(name, [])
+    try:
+        with open(path, "rb") as file:
+            content = file.read()
+    except FileNotFoundError:
+        update_highscores(name, highscores)
         return highscores
 
-    with open(path, "r") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            highscores.append({"name": row["name"], "score": int(row["score"]), "time": row["time"]})
+    for player, score, timestamp in parse_rows(content.decode())[1:]:
+        highscores.insert(int(score), int(timestamp), player)
+
+    try:
+        with open(f"tables/{name}.log", "rb") as file:
+            data = file.read().decode()
+    except FileNotFoundError:
+        data = ""
+
+    marker, _, rows = data.partition("\n")
+    if marker.startswith("#") and "," not in marker:
+        # a log for another snapshot was already compacted into this one,
+        # the process stopped before it could start the new log
+        if marker[1:] != snapshot_digest(content):
+            rows = ""
+    else:
+        # log without a marker, written before markers were added
+        rows = data
+
+    for player, score, timestamp in parse_rows(rows):
+        highscores.insert(int(score), int(timestamp), player)
 
-    # sort the highscores
-    highscores.sort(key=lambda x: x["score"], reverse=True)
     return highscores
 
-def update_highscores(name: str, highscores: typing.List[typing.Dict[str, int]]):
+def snapshot_digest(content: bytes) -> str:
+    return sha256(content).hexdigest()[:16]
+
+def update_highscores(name: str, highscores: Table) -> str:
     """
-    Update the highscores in a file.
+    Write the highscores of a table to its file.
 
     Format of the file should be:
-    name,score
+    name,score,time
+
+    Returns the digest of the written file.
     """
 
     path = f"tables/{name}.csv"
     # make sure the directory exists
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
-    with open(path, "w") as file:
-        writer = csv.DictWriter(file, fieldnames=["name", "score", "time"], lineterminator="\n", delimiter=",")
-        writer.writeheader()
-        for row in highscores:
-            writer.writerow(row)
+    lines = "".join(format_row(player, -neg_score, timestamp) for neg_score, timestamp, player in zip(highscores.neg_scores, highscores.times, highscores.names))
+    # write to a temporary file and swap it in, so the file is never seen half written
+    tmp_path = path + ".tmp"
+    content = ("name,score,time\n" + lines).encode()
+    with open(tmp_path, "wb", buffering=1 << 16) as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    return snapshot_digest(content)
+
+def append_highscore(name: str, score: int, timestamp: int, player: str):
+    """
+    Append a single accepted highscore to the log of a table.
+    """
+    with open(f"tables/{name}.log", "ab", buffering=0) as file:
+        file.write(format_row(player, score, timestamp).encode())
+
+def compact_highscores(name: str, highscores: Table):
+    """
+    Write the full table to the snapshot and start a new log for it.
+    """
+    digest = update_highscores(name, highscores)
+    with open(f"tables/{name}.log", "wb") as file:
+        file.write(f"#{digest}\n".encode())
 
 args = get_args()
 tables = args.tables.split(",")
@@ -83,14 +206,91 @@ if args.load_all:
             if table_name not in tables:
                 tables.append(table_name.strip().lower())
 
+# set for constant time lookups, kept in sync with tables
+TABLE_SET = set(tables)
+
+# the in-memory tables are authoritative, the files are only read once at startup.
+# published tables are never modified, saves replace them with an updated copy
+TABLES: typing.Dict[str, Table] = {}
+# serializes saves to the same table, reads go to the published table without locking
+LOCKS: typing.DefaultDict[str, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+# number of rows in the log of each table since the last compaction
+LOG_SIZES: typing.Dict[str, int] = {}
+# serialized json, its gzip compressed version and etag of each table, rebuilt whenever the table changes
+RESPONSE_CACHE: typing.Dict[str, typing.Tuple[bytes, bytes, str]] = {}
+# rendered html of each table view, dropped whenever the table or the list of tables changes
+HTML_CACHE: typing.Dict[str, bytes] = {}
+
+# responses smaller than this are not worth compressing
+GZIP_MINIMUM_SIZE = 500
+
+def to_highscores(name: str) -> dict:
+    # plain dict in the shape of Highscores, serialized directly by orjson
+    return {"name": name, "highscores": [{"name": player, "score": -neg_score} for neg_score, player in zip(TABLES[name].neg_scores, TABLES[name].names)]}
+
+def update_response_cache(name: str):
+    content = orjson.dumps(to_highscores(name))
+    RESPONSE_CACHE[name] = (content, gzip.compress(content), sha256(content).hexdigest()[:16])
+    HTML_CACHE.pop(name, None)
+
+def cached_response(name: str, request: Request, check_etag: bool = True) -> Response:
+    content, compressed, etag = RESPONSE_CACHE[name]
+    headers = {"Vary": "Accept-Encoding"}
+    # serve the pre-compressed bytes directly, the gzip middleware leaves encoded responses alone
+    if len(content) >= GZIP_MINIMUM_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        content = compressed
+        etag += "-gzip"
+        headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = f'"{etag}"'
+    if check_etag and request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+def load_table(name: str):
+    TABLES[name] = get_highscores(name)
+    compact_highscores(name, TABLES[name])
+    LOG_SIZES[name] = 0
+    update_response_cache(name)
+
+async def persist_highscore(name: str, score: int, timestamp: int, player: str):
+    """
+    Append the row to the log of the table, or compact the table once the log has grown to twice its size.
+    """
+    LOG_SIZES[name] += 1
+    # file writes happen in a worker thread to keep the event loop free
+    if LOG_SIZES[name] > 2 * args.size:
+        LOG_SIZES[name] = 0
+        await anyio.to_thread.run_sync(compact_highscores, name, TABLES[name])
+    else:
+        await anyio.to_thread.run_sync(append_highscore, name, score, timestamp, player)
+
+for table in tables:
+    load_table(table)
+
+SALT_BYTES = args.salt.encode()
+
+@lru_cache(maxsize=4096)
 def calc_secret_key(name: str, score: int) -> str:
-    return sha256(f"{name}{args.salt}{score}".encode()).hexdigest()
+    return sha256(name.encode() + SALT_BYTES + str(score).encode(), usedforsecurity=False).hexdigest()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=5)
 
 class Score(BaseModel):
+    # request bodies are only read, never modified
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     name: str
-    score: int
+    # scores are stored as signed 64 bit integers
+    score: int = Field(ge=-(2**63 - 1), le=2**63 - 1)
+
+    @field_validator("name")
+    @classmethod
+    def check_name(cls, name: str) -> str:
+        # names are stored as plain comma separated lines
+        if "," in name or "\n" in name or "\r" in name:
+            raise ValueError("Name must not contain commas or line breaks.")
+        return name
 
 class VerifiedScore(Score):
     secret: str
@@ -99,15 +299,23 @@ class Highscores(BaseModel):
     name: str
     highscores: typing.List[Score]
 
-def check_table(name: str):
-    if not name in tables:
-        if args.any_table:
-            tables.append(name.strip().lower())
-            return
-        raise HTTPException(status_code=404, detail="Table not found")
+def check_table(name: str) -> str:
+    """
+    Normalize a table name and make sure the table exists.
+
+    Returns the normalized name, which is the key of the table in TABLES and the caches.
+    """
+    name = name.strip().lower()
+    if not name in TABLE_SET:
+        if not args.any_table:
+            raise HTTPException(status_code=404, detail="Table not found")
+        tables.append(name)
+        TABLE_SET.add(name)
+        HTML_CACHE.clear()
+        load_table(name)
+    return name
 
 import markdown   
-@lru_cache()
 def get_readme_html():
     md = ""
     with open("README.md", "r") as f:
@@ -128,115 +336,97 @@ def get_readme_html():
 
     html = html.replace("{{md_html}}", md_html)
     return html
+
+def write_static_files():
+    """
+    Render the readme and copy the favicon into the static directory, which is served without going through the routes.
+    """
+    os.makedirs("static", exist_ok=True)
+    with open("static/index.html", "w", encoding="utf-8") as f:
+        f.write(get_readme_html())
+    shutil.copyfile("favicon.ico", "static/favicon.ico")
+
+write_static_files()
+app.mount("/static", StaticFiles(directory="static", html=True), name="static")
     
 @app.get("/")
-def read_root():
+async def read_root():
     return create_table_html(tables[0])
 
-@app.get("/readme")
-def read_readme():
-    return HTMLResponse(content=get_readme_html(), status_code=200)
-
-def _get_position_number(position: int) -> str:
-    if position == 0:
-        # crown
-        return "👑"
-    if position == 1:
-        # silver medal
-        return "🥈"
-    if position == 2:
-        # bronze medal
-        return "🥉"
-    return str(position + 1)
+# crown, silver and bronze medal for the first three positions
+MEDALS = ("👑", "🥈", "🥉")
 
 def create_table_html(name: str):
-    check_table(name)
-    skeleton = file_to_string_cached("view_skeleton.html")
-    highscores = get_highscores(name)
-    tables_this_first = [ name ] + [table for table in tables if table != name]
-    tables_html = "\n".join([f"<option value=\"{table}\">{table.capitalize()}</option>" for table in tables_this_first])
-    highscores_html = "\n".join([f"<tr><td>{_get_position_number(pos)}</td><td>{score['name']}</td><td class=\"score\">{score['score']}</td></tr>" for pos, score in enumerate(highscores)])
-
-    skeleton = skeleton.replace("{{options}}", tables_html)
-    skeleton = skeleton.replace("{{table}}", highscores_html)
-
-    return HTMLResponse(content=skeleton, status_code=200)
+    # runs on the event loop, like saves, so a render never mixes an old table with a new cache entry
+    name = check_table(name)
+    content = HTML_CACHE.get(name)
+    if content is None:
+        skeleton = file_to_string_cached("view_skeleton.html")
+        highscores = TABLES[name]
+        tables_this_first = [ name ] + [table for table in tables if table != name]
+        tables_html = "\n".join([f"<option value=\"{table}\">{table.capitalize()}</option>" for table in tables_this_first])
+        rows = bytearray()
+        for pos, (neg_score, player) in enumerate(zip(highscores.neg_scores, highscores.names)):
+            rows += f"<tr><td>{MEDALS[pos] if pos < 3 else pos + 1}</td><td>{player}</td><td class=\"score\">{-neg_score}</td></tr>\n".encode()
+
+        before, after = skeleton.replace("{{options}}", tables_html).split("{{table}}", 1)
+        content = HTML_CACHE[name] = before.encode() + bytes(rows) + after.encode()
+
+    return HTMLResponse(content=content, status_code=200)
 
 @app.get("/view/{name}")
-def view_table(name: str):
+async def view_table(name: str):
     return create_table_html(name)
 
 @app.get("/view")
-def view_table_default():
+async def view_table_default():
     return create_table_html(tables[0])
 
-@lru_cache()
-def get_favicon():
-    with open("favicon.ico", "rb") as f:
-        return f.read()
-    
-@app.get("/favicon.ico")
-def favicon():
-    return Response(content=get_favicon(), media_type="image/x-icon")
-
 @app.get("/highscores", response_model=typing.List[str])
 def get_tables():
     return tables
 
-@app.get("/highscore/{name}", response_model=Highscores)
-def get_highscore(name: str):
-    name = name.lower()
-    check_table(name)
+@app.get("/highscore/{name}", response_model=None, responses={200: {"model": Highscores}})
+async def get_highscore(name: str, request: Request):
+    name = check_table(name)
     
-    highscores = get_highscores(name)
-    highscore_response = Highscores(name=name, highscores=[Score(name=score["name"], score=score["score"]) for score in highscores])
-    return highscore_response
-
-if args.use_secret:
-    @app.post("/highscore/save/{name}", response_model=Highscores)
-    def save_highscore(name: str, score: VerifiedScore):
-        name = name.lower()
-        check_table(name)
-
-        if score.secret != calc_secret_key(score.name, score.score):
-            return JSONResponse(status_code=403, content={"message": "Invalid secret key."})
-
-        highscores = get_highscores(name)
-        lowest_score = highscores[-1]["score"] if len(highscores) > 0 else 0
-        if score.score <= lowest_score and len(highscores) >= args.size:
-            highscore_response = Highscores(name=name, highscores=[Score(name=score["name"], score=score["score"]) for score in highscores])
-            return highscore_response
-        
-        highscores.append({"name": score.name, "score": score.score, "time": int(time.time())})
-        highscores.sort(key=lambda x: x["score"], reverse=True)
-        if len(highscores) > args.size:
-            highscores = highscores[:args.size]
+    return cached_response(name, request)
 
-        update_highscores(name, highscores)
-        get_highscores.cache_clear()
-        highscore_response = Highscores(name=name, highscores=[Score(name=score["name"], score=score["score"]) for score in highscores])
-        return highscore_response
-else:
-    @app.post("/highscore/save/{name}", response_model=Highscores)
-    def save_highscore(name: str, score: Score):
-        name = name.lower()
-        check_table(name)
-
-        highscores = get_highscores(name)
-        lowest_score = highscores[-1]["score"] if len(highscores) > 0 else 0
-        if score.score <= lowest_score and len(highscores) >= args.size:
-            highscore_response = Highscores(name=name, highscores=[Score(name=score["name"], score=score["score"]) for score in highscores])
-            return highscore_response
-        
-        highscores.append({"name": score.name, "score": score.score, "time": int(time.time())})
-        highscores.sort(key=lambda x: x["score"], reverse=True)
-        if len(highscores) > args.size:
-            highscores = highscores[:args.size]
+def verify_secret(score: VerifiedScore) -> bool:
+    return hmac.compare_digest(score.secret.encode(), calc_secret_key(score.name, score.score).encode())
 
-        update_highscores(name, highscores)
-        get_highscores.cache_clear()
-        highscore_response = Highscores(name=name, highscores=[Score(name=score["name"], score=score["score"]) for score in highscores])
-        return highscore_response
+# the expected request body and its check are picked once at startup
+SubmittedScore = VerifiedScore if args.use_secret else Score
+verify_score = verify_secret if args.use_secret else lambda score: True
+
+@app.post("/highscore/save/{name}", response_model=None, responses={200: {"model": Highscores}})
+async def save_highscore(name: str, score: SubmittedScore, request: Request):
+    name = check_table(name)
+
+    if not verify_score(score):
+        return JSONResponse(status_code=403, content={"message": "Invalid secret key."})
+
+    if not TABLES[name].accepts(score.score):
+        return cached_response(name, request, check_etag=False)
+
+    async with LOCKS[name]:
+        table = TABLES[name].copy()
+        timestamp = int(time.time())
+        if table.insert(score.score, timestamp, score.name):
+            TABLES[name] = table
+            update_response_cache(name)
+            await persist_highscore(name, score.score, timestamp, score.name)
+
+    return cached_response(name, request, check_etag=False)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
\ No newline at end of file
+    # loop and http "auto" pick uvloop and httptools when they are installed
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=args.port,
+        loop="auto",
+        http="auto",
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+    )
\ No newline at end of file